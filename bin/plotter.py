@@ -10,10 +10,11 @@
 # according to the number of aligned nt-pairs within it, but the
 # result is too faint.  How can this be done better?
 
-import collections
+import bisect
 import functools
 import gzip
-from fnmatch import fnmatchcase
+import heapq
+from fnmatch import translate
 import logging
 from operator import itemgetter
 import subprocess
@@ -37,10 +38,31 @@ def groupByFirstItem(things):
         yield k, [i[1:] for i in v]
 
 def commaSeparatedInts(text):
-    return map(int, text.rstrip(",").split(","))
+    return list(map(int, text.rstrip(",").split(",")))
 
 def croppedBlocks(blocks, ranges1, ranges2):
-    headBeg1, headBeg2, headSize = blocks[0]
+    beg1s, beg2s, sizes = blocks
+    headBeg1 = beg1s[0]
+    headBeg2 = beg2s[0]
+    if len(ranges1) == 1 and len(ranges2) == 1:
+        (cropBeg1, cropEnd1), = ranges1
+        (cropBeg2, cropEnd2), = ranges2
+        if headBeg1 < 0:
+            cropBeg1, cropEnd1 = -cropEnd1, -cropBeg1
+        if headBeg2 < 0:
+            cropBeg2, cropEnd2 = -cropEnd2, -cropBeg2
+        tailSize = sizes[-1]
+        if (cropBeg1 <= headBeg1 and beg1s[-1] + tailSize <= cropEnd1 and
+            cropBeg2 <= headBeg2 and beg2s[-1] + tailSize <= cropEnd2 and
+            all(sizes)):
+            return blocks  # nothing to crop, so don't copy the blocks
+    newBeg1s = []
+    newBeg2s = []
+    newSizes = []
+    # local names are quicker than globals & attributes in the loop below
+    maxOf, minOf = max, min
+    addBeg1, addBeg2 = newBeg1s.append, newBeg2s.append
+    addSize = newSizes.append
     for r1 in ranges1:
         for r2 in ranges2:
             cropBeg1, cropEnd1 = r1
@@ -49,59 +71,87 @@ def croppedBlocks(blocks, ranges1, ranges2):
             cropBeg2, cropEnd2 = r2
             if headBeg2 < 0:
                 cropBeg2, cropEnd2 = -cropEnd2, -cropBeg2
-            for beg1, beg2, size in blocks:
-                b1 = max(cropBeg1, beg1)
-                e1 = min(cropEnd1, beg1 + size)
+            for beg1, beg2, size in zip(beg1s, beg2s, sizes):
+                b1 = maxOf(cropBeg1, beg1)
+                e1 = minOf(cropEnd1, beg1 + size)
                 if b1 >= e1: continue
                 offset = beg2 - beg1
-                b2 = max(cropBeg2, b1 + offset)
-                e2 = min(cropEnd2, e1 + offset)
+                b2 = maxOf(cropBeg2, b1 + offset)
+                e2 = minOf(cropEnd2, e1 + offset)
                 if b2 >= e2: continue
-                yield b2 - offset, b2, e2 - b2
+                addBeg1(b2 - offset)
+                addBeg2(b2)
+                addSize(e2 - b2)
+    return newBeg1s, newBeg2s, newSizes
 
 def tabBlocks(blocks, beg1, beg2, sizeMul, seq1mul, seq2mul):
     '''Get the gapless blocks of an alignment, from LAST tabular format.'''
+    beg1s = []
+    beg2s = []
+    sizes = []
+    addBeg1, addBeg2, addSize = beg1s.append, beg2s.append, sizes.append
     for i in blocks:
         if len(i) > 1:
             beg1 += i[0]
             beg2 += i[1]
         else:
             size = i[0]
-            yield beg1 * seq1mul, beg2 * seq2mul, size * sizeMul
+            addBeg1(beg1 * seq1mul)
+            addBeg2(beg2 * seq2mul)
+            addSize(size * sizeMul)
             beg1 += size * seq2mul
             beg2 += size * seq1mul
+    return beg1s, beg2s, sizes
+
+gapRunPattern = re.compile("-+")
 
 def mafBlocks(beg1, beg2, seq1, seq2):
     '''Get the gapless blocks of an alignment, from MAF format.'''
-    size = 0
-    for x, y in zip(seq1, seq2):
-        if x == "-":
-            if size:
-                yield beg1, beg2, size
-                beg1 += size
-                beg2 += size
-                size = 0
-            beg2 += 1
-        elif y == "-":
-            if size:
-                yield beg1, beg2, size
-                beg1 += size
-                beg2 += size
-                size = 0
-            beg1 += 1
+    # Step over runs of gaps rather than single columns
+    gaps1 = [(m.start(), m.end(), 1) for m in gapRunPattern.finditer(seq1)]
+    gaps2 = [(m.start(), m.end(), 2) for m in gapRunPattern.finditer(seq2)]
+    gaps = sorted(gaps1 + gaps2)
+    # runs in one row never overlap, so overlapping neighbors mean some
+    # column is a gap in both rows: count it as a gap in seq1 only, as a
+    # column-by-column walk would
+    if any(i[1] > j[0] for i, j in zip(gaps, gaps[1:])):
+        seq2 = "".join("x" if x == "-" else y for x, y in zip(seq1, seq2))
+        gaps2 = [(m.start(), m.end(), 2) for m in gapRunPattern.finditer(seq2)]
+        gaps = sorted(gaps1 + gaps2)
+    beg1s = []
+    beg2s = []
+    sizes = []
+    addBeg1, addBeg2, addSize = beg1s.append, beg2s.append, sizes.append
+    pos = 0
+    for gapBeg, gapEnd, gappedRow in gaps:
+        size = gapBeg - pos
+        if size > 0:
+            addBeg1(beg1)
+            addBeg2(beg2)
+            addSize(size)
+            beg1 += size
+            beg2 += size
+        if gappedRow == 1:
+            beg2 += gapEnd - gapBeg
         else:
-            size += 1
-    if size: yield beg1, beg2, size
+            beg1 += gapEnd - gapBeg
+        pos = gapEnd
+    size = min(len(seq1), len(seq2)) - pos
+    if size > 0:
+        addBeg1(beg1)
+        addBeg2(beg2)
+        addSize(size)
+    return beg1s, beg2s, sizes
 
 def alignmentFromSegment(qrySeqName, qrySeqLen, segment):
     refSeqLen = sys.maxsize  # XXX
     refSeqName, refSeqBeg, qrySeqBeg, size = segment
-    block = refSeqBeg, qrySeqBeg, size
-    return refSeqName, refSeqLen, qrySeqName, qrySeqLen, [block]
+    blocks = [refSeqBeg], [qrySeqBeg], [size]
+    return refSeqName, refSeqLen, qrySeqName, qrySeqLen, blocks
 
 def dataFromPsl(strand, seqName, seqLen, alnBeg, alnEnd, blockBegs, blockLens):
     seqLen = int(seqLen)
-    blockBegs = list(commaSeparatedInts(blockBegs))
+    blockBegs = commaSeparatedInts(blockBegs)
     if strand == "+":
         end = int(alnEnd)
     else:
@@ -138,40 +188,42 @@ def alignmentInput(lines):
     qrySeqName = ""
     segments = []
     for line in lines:
+        c = line[:1]
+        if c == "#": continue  # don't bother splitting comment lines
         w = line.split()
-        if line[0] == "#":
-            pass
-        elif len(w) == 1:
+        n = len(w)
+        if n == 1:
             for i in segments:
                 yield alignmentFromSegment(qrySeqName, qrySeqLen, i)
             qrySeqName = w[0]
             qrySeqLen = 0
             segments = []
-        elif len(w) == 2 and qrySeqName and w[1].isdigit():
+        elif n == 2 and qrySeqName and w[1].isdigit():
             qrySeqLen += int(w[1])
-        elif len(w) == 4 and qrySeqName and w[1].isdigit() and w[3].isdigit():
+        elif n == 4 and qrySeqName and w[1].isdigit() and w[3].isdigit():
             refSeqName, refSeqBeg, refSeqEnd = w[0], int(w[1]), int(w[3])
             size = abs(refSeqEnd - refSeqBeg)
             if refSeqBeg > refSeqEnd:
                 refSeqBeg = -refSeqBeg
             segments.append((refSeqName, refSeqBeg, qrySeqLen, size))
             qrySeqLen += size
-        elif len(w) > 20:  # PSL format
+        elif n > 20:  # PSL format
             strand = w[8]
             strand2 = strand[0]
             strand1 = strand[1] if len(strand) > 1 else "+"
-            sizes = list(commaSeparatedInts(w[18]))
+            sizes = commaSeparatedInts(w[18])
             d1 = dataFromPsl(strand1, w[13], w[14], w[15], w[16], w[20], sizes)
             d2 = dataFromPsl(strand2, w[ 9], w[10], w[11], w[12], w[19], sizes)
             chr1, seqlen1, beg1s, isTransDna1 = d1
             chr2, seqlen2, beg2s, isTransDna2 = d2
             sizeMul, seq1mul, seq2mul = aaToNtFactors(isTransDna1, isTransDna2)
-            sizes = [i * sizeMul for i in sizes]
-            beg1s = [i * seq1mul for i in beg1s]
-            beg2s = [i * seq2mul for i in beg2s]
-            blocks = zip(beg1s, beg2s, sizes)
+            # the factors are 1 unless protein is involved: skip the copies
+            if sizeMul > 1: sizes = [i * sizeMul for i in sizes]
+            if seq1mul > 1: beg1s = [i * seq1mul for i in beg1s]
+            if seq2mul > 1: beg2s = [i * seq2mul for i in beg2s]
+            blocks = beg1s, beg2s, sizes
             yield chr1, seqlen1 * seq1mul, chr2, seqlen2 * seq2mul, blocks
-        elif line[0].isdigit():  # tabular format
+        elif c.isdigit():  # tabular format
             blocks = w[11].split(",")
             blocks = [[int(j) for j in i.split(":")] for i in blocks]
             blockSum1 = sum(i[0] for i in blocks)
@@ -181,7 +233,7 @@ def alignmentInput(lines):
             sizeMul, seq1mul, seq2mul = aaToNtFactors(isTransDna1, isTransDna2)
             blocks = tabBlocks(blocks, beg1, beg2, sizeMul, seq1mul, seq2mul)
             yield chr1, seqlen1 * seq1mul, chr2, seqlen2 * seq2mul, blocks
-        elif line[0] == "s":  # MAF format
+        elif c == "s":  # MAF format
             if mafCount == 0:
                 chr1, seqlen1, beg1, seq1 = dataFromMaf(*w)
                 mafCount = 1
@@ -204,14 +256,20 @@ def seqRequestFromText(text):
             return pattern, int(beg), int(end)  # beg may be negative
     return text, 0, sys.maxsize
 
+def compiledSeqRequests(texts):
+    '''Get sequence requests, with each name pattern compiled just once.'''
+    for text in texts:
+        pattern, beg, end = seqRequestFromText(text)
+        yield re.compile(translate(pattern)).match, beg, end
+
 def rangesFromSeqName(seqRequests, name, seqLen):
-    if seqRequests:
-        base = name.split(".", 1)[-1]  # allow for names like hg19.chr7
-        for pat, beg, end in seqRequests:
-            if fnmatchcase(name, pat) or fnmatchcase(base, pat):
-                yield max(beg, 0), min(end, seqLen)
-    else:
-        yield 0, seqLen
+    '''Get the sorted ranges to show for one sequence.'''
+    if not seqRequests:
+        return [(0, seqLen)]
+    base = name.split(".", 1)[-1]  # allow for names like hg19.chr7
+    return sorted((max(beg, 0), min(end, seqLen))
+                  for isMatch, beg, end in seqRequests
+                  if isMatch(name) or isMatch(base))
 
 def updateSeqs(coverDict, seqRanges, seqName, ranges, coveredRange):
     beg, end = coveredRange
@@ -227,8 +285,8 @@ def updateSeqs(coverDict, seqRanges, seqName, ranges, coveredRange):
 
 def readAlignments(fileName, opts, split=False):
     '''Read alignments and sequence limits.'''
-    seqRequests1 = [seqRequestFromText(i) for i in opts.seq1]
-    seqRequests2 = [seqRequestFromText(i) for i in opts.seq2]
+    seqRequests1 = list(compiledSeqRequests(opts.seq1))
+    seqRequests2 = list(compiledSeqRequests(opts.seq2))
 
     alignments = []
     seqRanges1 = []
@@ -248,17 +306,18 @@ def readAlignments(fileName, opts, split=False):
             coverDict1 = {}
             coverDict2 = {}
             splitBy = seqName2
-        ranges1 = sorted(rangesFromSeqName(seqRequests1, seqName1, seqLen1))
+        ranges1 = rangesFromSeqName(seqRequests1, seqName1, seqLen1)
         if not ranges1: continue
-        ranges2 = sorted(rangesFromSeqName(seqRequests2, seqName2, seqLen2))
+        ranges2 = rangesFromSeqName(seqRequests2, seqName2, seqLen2)
         if not ranges2: continue
-        b = list(croppedBlocks(list(blocks), ranges1, ranges2))
-        if not b: continue
-        aln = seqName1, seqName2, b
+        b = croppedBlocks(blocks, ranges1, ranges2)
+        beg1s, beg2s, sizes = b
+        if not sizes: continue
+        aln = seqName1, seqName2, b, sum(sizes)
         alignments.append(aln)
-        coveredRange1 = b[0][0], b[-1][0] + b[-1][2]
+        coveredRange1 = beg1s[0], beg1s[-1] + sizes[-1]
         updateSeqs(coverDict1, seqRanges1, seqName1, ranges1, coveredRange1)
-        coveredRange2 = b[0][1], b[-1][1] + b[-1][2]
+        coveredRange2 = beg2s[0], beg2s[-1] + sizes[-1]
         updateSeqs(coverDict2, seqRanges2, seqName2, ranges2, coveredRange2)
     
     if split:
@@ -296,15 +355,16 @@ def readSecondaryAlignments(opts, cropRanges1, cropRanges2):
             continue
         r1 = rangesForSecondaryAlignments(ranges1, seqLen1)
         r2 = rangesForSecondaryAlignments(ranges2, seqLen2)
-        b = list(croppedBlocks(list(blocks), r1, r2))
-        if not b: continue
-        aln = seqName1, seqName2, b
+        b = croppedBlocks(blocks, r1, r2)
+        beg1s, beg2s, sizes = b
+        if not sizes: continue
+        aln = seqName1, seqName2, b, sum(sizes)
         alignments.append(aln)
         if not ranges1:
-            coveredRange1 = b[0][0], b[-1][0] + b[-1][2]
+            coveredRange1 = beg1s[0], beg1s[-1] + sizes[-1]
             updateSeqs(coverDict1, seqRanges1, seqName1, r1, coveredRange1)
         if not ranges2:
-            coveredRange2 = b[0][1], b[-1][1] + b[-1][2]
+            coveredRange2 = beg2s[0], beg2s[-1] + sizes[-1]
             updateSeqs(coverDict2, seqRanges2, seqName2, r2, coveredRange2)
     return alignments, seqRanges1, coverDict1, seqRanges2, coverDict2
 
@@ -352,27 +412,35 @@ def trimmed(seqRanges, coverDict, minAlignedBases, maxGapFrac, endPad, midPad):
             rangeEnd = blocks[-1][1] + endPad
         yield seqName, rangeBeg, rangeEnd
 
-def rangesWithStrandInfo(seqRanges, strandOpt, alignments, seqIndex):
-    if strandOpt == "1":
-        forwardMinusReverse = collections.defaultdict(int)
-        for i in alignments:
-            blocks = i[2]
-            beg1, beg2, size = blocks[0]
-            numOfAlignedLetterPairs = sum(i[2] for i in blocks)
-            if (beg1 < 0) != (beg2 < 0):  # opposite-strand alignment
-                numOfAlignedLetterPairs *= -1
-            forwardMinusReverse[i[seqIndex]] += numOfAlignedLetterPairs
+def strandBalancePerSeq(alignments, seqIndex):
+    '''Get forward minus reverse aligned letter-pairs for each sequence.'''
+    forwardMinusReverse = {}
+    get = forwardMinusReverse.get
+    for i in alignments:
+        beg1s, beg2s, sizes = i[2]
+        numOfAlignedLetterPairs = i[3]
+        if (beg1s[0] < 0) != (beg2s[0] < 0):  # opposite-strand alignment
+            numOfAlignedLetterPairs *= -1
+        seqName = i[seqIndex]
+        numOfAlignedLetterPairs += get(seqName, 0)
+        forwardMinusReverse[seqName] = numOfAlignedLetterPairs
+    return forwardMinusReverse
+
+def rangesWithStrandInfo(seqRanges, strandOpt, forwardMinusReverse):
     strandNum = 0
     for seqName, beg, end in seqRanges:
         if strandOpt == "1":
-            strandNum = 1 if forwardMinusReverse[seqName] >= 0 else 2
+            strandNum = 1 if forwardMinusReverse.get(seqName, 0) >= 0 else 2
         yield seqName, beg, end, strandNum
 
+digitsPattern = re.compile(r'(\d+)')
+
+@functools.lru_cache(maxsize=None)
 def natural_sort_key(my_string):
     '''Return a sort key for "natural" ordering, e.g. chr9 < chr10.'''
-    parts = re.split(r'(\d+)', my_string)
+    parts = digitsPattern.split(my_string)
     parts[1::2] = map(int, parts[1::2])
-    return parts
+    return tuple(parts)
 
 def nameKey(oneSeqRanges):
     return natural_sort_key(oneSeqRanges[0][0])
@@ -402,10 +470,11 @@ def alignmentSortData(alignments, seqIndex, otherNamesToRanksAndFlips):
     otherIndex = 1 - seqIndex
     for i in alignments:
         blocks = i[2]
+        otherBegs = blocks[otherIndex]
+        sizes = blocks[2]
         otherRank, otherFlip = otherNamesToRanksAndFlips[i[otherIndex]]
-        otherPos = otherFlip * abs(blocks[0][otherIndex] +
-                                   blocks[-1][otherIndex] + blocks[-1][2])
-        numOfAlignedLetterPairs = sum(i[2] for i in blocks)
+        otherPos = otherFlip * abs(otherBegs[0] + otherBegs[-1] + sizes[-1])
+        numOfAlignedLetterPairs = i[3]
         yield i[seqIndex], otherRank, otherPos, numOfAlignedLetterPairs
 
 def mySortedRanges(seqRanges, sortOpt, seqIndex, alignments, otherRanges):
@@ -433,10 +502,14 @@ def allSortedRanges(opts, alignments, alignmentsB,
     o2, oB2 = twoValuesFromOption(opts.strands2, ":")
     if o1 == "1" and o2 == "1":
         raise RuntimeError("the strand options have circular dependency")
-    seqRanges1 = list(rangesWithStrandInfo(seqRanges1, o1, alignments, 0))
-    seqRanges2 = list(rangesWithStrandInfo(seqRanges2, o2, alignments, 1))
-    seqRangesB1 = list(rangesWithStrandInfo(seqRangesB1, oB1, alignmentsB, 0))
-    seqRangesB2 = list(rangesWithStrandInfo(seqRangesB2, oB2, alignmentsB, 1))
+    b1 = strandBalancePerSeq(alignments, 0) if o1 == "1" else None
+    b2 = strandBalancePerSeq(alignments, 1) if o2 == "1" else None
+    bB1 = strandBalancePerSeq(alignmentsB, 0) if oB1 == "1" else None
+    bB2 = strandBalancePerSeq(alignmentsB, 1) if oB2 == "1" else None
+    seqRanges1 = list(rangesWithStrandInfo(seqRanges1, o1, b1))
+    seqRanges2 = list(rangesWithStrandInfo(seqRanges2, o2, b2))
+    seqRangesB1 = list(rangesWithStrandInfo(seqRangesB1, oB1, bB1))
+    seqRangesB2 = list(rangesWithStrandInfo(seqRangesB2, oB2, bB2))
 
     o1, oB1 = twoValuesFromOption(opts.sort1, ":")
     o2, oB2 = twoValuesFromOption(opts.sort2, ":")
@@ -454,19 +527,22 @@ def allSortedRanges(opts, alignments, alignmentsB,
     t2 = mySortedRanges(seqRangesB2, oB2, 1, alignmentsB, s1)
     return s1 + t1, s2 + t2
 
-def myTextsize(textDraw, font, text):
+def myTextsize(textDraw, font, text, sizeCache):
+    if text in sizeCache:
+        return sizeCache[text]
     try:
         out = textDraw.textsize(text, font=font)
     except AttributeError:
         a, b, c, d = textDraw.textbbox((0, 0), text, font=font)
         out = c, d
+    sizeCache[text] = out
     return out
 
-def sizesPerText(texts, font, textDraw):
+def sizesPerText(texts, font, textDraw, sizeCache):
     sizes = 0, 0
     for t in texts:
         if textDraw is not None:
-            sizes = myTextsize(textDraw, font, t)
+            sizes = myTextsize(textDraw, font, t, sizeCache)
         yield t, sizes
 
 def prettyNum(n):
@@ -496,17 +572,18 @@ def labelText(seqRange, labelOpt):
         return seqName + ":" + prettyNum(beg) + "-" + prettyNum(end)
     return seqName
 
-def rangeLabels(seqRanges, labelOpt, font, textDraw, textRot):
+def rangeLabels(seqRanges, labelOpt, font, textDraw, sizeCache, textRot):
     x = y = 0
     for r in seqRanges:
         text = labelText(r, labelOpt)
         if textDraw is not None:
-            x, y = myTextsize(textDraw, font, text)
+            x, y = myTextsize(textDraw, font, text, sizeCache)
             if textRot:
                 x, y = y, x
         yield text, x, y, r[3]
 
-def dataFromRanges(sortedRanges, font, textDraw, labelOpt, textRot):
+def dataFromRanges(sortedRanges, font, textDraw, sizeCache, labelOpt,
+                   textRot):
     for seqName, rangeBeg, rangeEnd, strandNum in sortedRanges:
         out = [seqName, str(rangeBeg), str(rangeEnd)]
         if strandNum > 0:
@@ -514,15 +591,15 @@ def dataFromRanges(sortedRanges, font, textDraw, labelOpt, textRot):
         logging.info("\t".join(out))
     logging.info("")
     rangeSizes = [e - b for n, b, e, s in sortedRanges]
-    labs = list(rangeLabels(sortedRanges, labelOpt, font, textDraw, textRot))
+    labs = list(rangeLabels(sortedRanges, labelOpt, font, textDraw,
+                            sizeCache, textRot))
     margin = max(i[2] for i in labs)
     # xxx the margin may be too big, because some labels may get omitted
     return rangeSizes, labs, margin
 
 def div_ceil(x, y):
     '''Return x / y rounded up.'''
-    q, r = divmod(x, y)
-    return q + (r != 0)
+    return -(x // -y)
 
 def get_bp_per_pix(rangeSizes, pixTweenRanges, maxPixels):
     '''Get the minimum bp-per-pixel that fits in the size limit.'''
@@ -555,71 +632,102 @@ def pixelData(rangeSizes, bp_per_pix, pixTweenRanges, margin):
     tot_pix = rangePixBegs[-1] + rangePixLens[-1]
     return rangePixBegs, rangePixLens, tot_pix
 
-def drawLineForward(hits, width, bp_per_pix, beg1, beg2, size):
-    while True:
-        q1, r1 = divmod(beg1, bp_per_pix)
-        q2, r2 = divmod(beg2, bp_per_pix)
-        hits[q2 * width + q1] |= 1
-        next_pix = min(bp_per_pix - r1, bp_per_pix - r2)
-        if next_pix >= size: break
-        beg1 += next_pix
-        beg2 += next_pix
-        size -= next_pix
-
-def drawLineReverse(hits, width, bp_per_pix, beg1, beg2, size):
-    while True:
-        q1, r1 = divmod(beg1, bp_per_pix)
-        q2, r2 = divmod(beg2, bp_per_pix)
-        hits[q2 * width + q1] |= 2
-        next_pix = min(bp_per_pix - r1, r2 + 1)
-        if next_pix >= size: break
-        beg1 += next_pix
-        beg2 -= next_pix
-        size -= next_pix
-
-def strandAndOrigin(ranges, beg, size):
+# Translation tables that OR a strand bit into every byte of a slice
+orForward = bytes(i | 1 for i in range(256))
+orReverse = bytes(i | 2 for i in range(256))
+
+def pixelSpan(bp_per_pix, beg, offset, size):
+    '''Get the first & last x pixels of one diagonal that a block touches.'''
+    lo = max(-beg, offset)
+    hi = min(bp_per_pix - 1 - beg, bp_per_pix - 1 + offset)
+    if lo > hi: return 1, 0
+    return -(hi // bp_per_pix), (size - 1 - lo) // bp_per_pix
+
+def drawLine(hits, width, bp_per_pix, beg1, beg2, size, sign2):
+    '''Mark the pixels of one gapless block: forward if sign2 > 0.'''
+    # A reverse line is a forward line with beg2 mirrored and y flipped
+    if sign2 > 0:
+        orBits, rowStep, rowBeg = orForward, width, 0
+    else:
+        orBits, rowStep, rowBeg = orReverse, -width, -width
+        beg2 = -1 - beg2
+    q1, r1 = divmod(beg1, bp_per_pix)
+    q2, r2 = divmod(beg2, bp_per_pix)
+    if size <= bp_per_pix - max(r1, r2):  # the line is inside one pixel
+        i = rowBeg + q2 * rowStep + q1
+        hits[i] = orBits[hits[i]]
+        return
+    # The line's pixels lie on at most 2 diagonals: OR each one as a slice
+    step = rowStep + 1
+    diff = (beg1 - beg2) // bp_per_pix
+    for d in (diff, diff + 1):
+        offset = -d * bp_per_pix - beg2
+        xBeg, xEnd = pixelSpan(bp_per_pix, beg1, offset, size)
+        if xBeg > xEnd: continue
+        i = rowBeg - d * rowStep + xBeg * step
+        j = rowBeg - d * rowStep + xEnd * step
+        s = slice(min(i, j), max(i, j) + 1, abs(step))
+        hits[s] = hits[s].translate(orBits)
+
+def rangeEndsPerSeq(rangeDict, endIndex=1):
+    '''Get the running maximum end of each sequence's (sorted) ranges.'''
+    # ranges can nest, so their ends may not be sorted, but these are
+    getEnd = itemgetter(endIndex)
+    return dict((k, list(itertools.accumulate(map(getEnd, v), max)))
+                for k, v in rangeDict.items())
+
+def strandAndOrigin(ranges, rangeEnds, beg, size):
     isReverseStrand = (beg < 0)
     if isReverseStrand:
         beg = -(beg + size)
-    for rangeBeg, rangeEnd, isReverseRange, origin in ranges:
-        if rangeEnd > beg:  # assumes the ranges are sorted
-            return (isReverseStrand != isReverseRange), origin
+    # find the first range with rangeEnd > beg: it's the first one whose
+    # running maximum end is > beg
+    i = bisect.bisect_right(rangeEnds, beg)
+    rangeBeg, rangeEnd, isReverseRange, origin = ranges[i]
+    return (isReverseStrand != isReverseRange), origin
 
 def alignmentPixels(width, height, alignments, bp_per_pix,
-                    rangeDict1, rangeDict2):
-    hits = [0] * (width * height)  # the image data
-    for seq1, seq2, blocks in alignments:
-        beg1, beg2, size = blocks[0]
-        isReverse1, ori1 = strandAndOrigin(rangeDict1[seq1], beg1, size)
-        isReverse2, ori2 = strandAndOrigin(rangeDict2[seq2], beg2, size)
-        for beg1, beg2, size in blocks:
-            if isReverse1:
-                beg1 = -(beg1 + size)
-                beg2 = -(beg2 + size)
-            if isReverse1 == isReverse2:
-                drawLineForward(hits, width, bp_per_pix,
-                                ori1 + beg1, ori2 + beg2, size)
-            else:
-                drawLineReverse(hits, width, bp_per_pix,
-                                ori1 + beg1, ori2 - beg2 - 1, size)
+                    rangeDict1, rangeDict2, rangeEnds1, rangeEnds2):
+    hits = bytearray(width * height)  # the image data
+    for seq1, seq2, blocks, numOfAlignedLetterPairs in alignments:
+        beg1s, beg2s, sizes = blocks
+        beg1, beg2, size = beg1s[0], beg2s[0], sizes[0]
+        isReverse1, ori1 = strandAndOrigin(rangeDict1[seq1], rangeEnds1[seq1],
+                                           beg1, size)
+        isReverse2, ori2 = strandAndOrigin(rangeDict2[seq2], rangeEnds2[seq2],
+                                           beg2, size)
+        sign2 = 1 if isReverse1 == isReverse2 else -1
+        if sign2 < 0:
+            ori2 -= 1
+        if isReverse1:
+            for beg1, beg2, size in zip(beg1s, beg2s, sizes):
+                drawLine(hits, width, bp_per_pix, ori1 - beg1 - size,
+                         ori2 - sign2 * (beg2 + size), size, sign2)
+        else:
+            for beg1, beg2, size in zip(beg1s, beg2s, sizes):
+                drawLine(hits, width, bp_per_pix, ori1 + beg1,
+                         ori2 + sign2 * beg2, size, sign2)
     return hits
 
 def orientedBlocks(alignments, seqIndex):
     otherIndex = 1 - seqIndex
     for a in alignments:
-        seq1, seq2, blocks = a
-        for b in blocks:
+        for b in zip(*a[2]):
             beg1, beg2, size = b
             if b[seqIndex] < 0:
                 b = -(beg1 + size), -(beg2 + size), size
             yield a[seqIndex], b[seqIndex], a[otherIndex], b[otherIndex], size
 
-def drawJoins(im, alignments, bpPerPix, seqIndex, rangeDict1, rangeDict2):
+def drawJoins(joins, width, alignments, bpPerPix, seqIndex,
+              rangeDict1, rangeDict2, rangeEnds1, rangeEnds2):
     blocks = orientedBlocks(alignments, seqIndex)
+    height = len(joins) // width
     oldSeq1 = ""
     for seq1, beg1, seq2, beg2, size in sorted(blocks):
-        isReverse1, ori1 = strandAndOrigin(rangeDict1[seq1], beg1, size)
-        isReverse2, ori2 = strandAndOrigin(rangeDict2[seq2], beg2, size)
+        isReverse1, ori1 = strandAndOrigin(rangeDict1[seq1], rangeEnds1[seq1],
+                                           beg1, size)
+        isReverse2, ori2 = strandAndOrigin(rangeDict2[seq2], rangeEnds2[seq2],
+                                           beg2, size)
         end1 = beg1 + size - 1
         end2 = beg2 + size - 1
         if isReverse1:
@@ -638,11 +746,18 @@ def drawJoins(im, alignments, bpPerPix, seqIndex, rangeDict1, rangeDict2):
                 midPix1 = (oldPix1 + newPix1 + 1) // 2
                 oldPix1, newPix1 = newPix1, oldPix1
             if upperPix2 - lowerPix2 > 1 and oldPix1 <= newPix1 <= oldPix1 + 1:
-                if seqIndex == 0:
-                    box = midPix1, lowerPix2, midPix1 + 1, upperPix2 + 1
-                else:
-                    box = lowerPix2, midPix1, upperPix2 + 1, midPix1 + 1
-                im.paste("lightgray", box)
+                # clip the line to the image, as im.paste would
+                beg = max(lowerPix2, 0)
+                if seqIndex == 0:  # vertical line
+                    end = min(upperPix2 + 1, height)
+                    if 0 <= midPix1 < width and beg < end:
+                        i = beg * width + midPix1
+                        joins[i:end * width:width] = b"\xff" * (end - beg)
+                else:  # horizontal line
+                    end = min(upperPix2 + 1, width)
+                    if 0 <= midPix1 < height and beg < end:
+                        i = midPix1 * width
+                        joins[i + beg:i + end] = b"\xff" * (end - beg)
         oldPix1 = (ori1 + end1) // bpPerPix
         oldPix2 = (ori2 + end2) // bpPerPix
         oldSeq1 = seq1
@@ -733,8 +848,10 @@ def annotsFromRep(rangeDict, seqName, beg, end, strand, repName, repClass):
 
 def annotsFromFiles(opts, fileNames, rangeDict):
     isDig = str.isdigit
+    rangeEnds = rangeEndsPerSeq(rangeDict, 2)
     for fileName in fileNames:
         for line in openFile(fileName):
+            if line[:1] == "#": continue  # before the split, for speed
             w = line.split()
             n = len(w)
             if n > 10 and w[8] in "+C-" and isDig(w[5]) and isDig(w[6]):
@@ -765,18 +882,27 @@ def annotsFromFiles(opts, fileNames, rangeDict):
                 g = annotsFromBedOrAgp(opts, rangeDict, w[1:])
             else:
                 continue
-            if line[0] == "#": continue
             for i in g:
                 layer, color, seqName, beg, end, name = i
-                if any(beg < r[2] and end > r[1] for r in rangeDict[seqName]):
+                # the first range with rangeEnd > beg: the ranges before it
+                # end too soon, & the ones after it start no sooner
+                ranges = rangeDict[seqName]
+                j = bisect.bisect_right(rangeEnds[seqName], beg)
+                if j < len(ranges) and ranges[j][1] < end:
                     yield i
 
-def bedBoxes(annots, rangeDict, limit, isTop, bpPerPix):
+def bedBoxes(annots, rangeDict, rangeEnds, limit, isTop, bpPerPix):
     beds, textSizes, margin = annots
     cover = [(limit, limit)]
+    negBpPerPix = -bpPerPix  # -(x // negBpPerPix) is x / bpPerPix rounded up
     for layer, color, seqName, bedBeg, bedEnd, name in reversed(beds):
         textWidth, textHeight = textSizes[name]
-        for rangeBeg, rangeEnd, isReverseRange, origin in rangeDict[seqName]:
+        ranges = rangeDict[seqName]
+        # skip the ranges that end before this annotation: rangeEnds has
+        # running maximum ends, so nested ranges after i are still visited
+        i = bisect.bisect_right(rangeEnds[seqName], bedBeg)
+        for rangeBeg, rangeEnd, isReverseRange, origin in ranges[i:]:
+            if rangeBeg >= bedEnd: break
             beg = max(bedBeg, rangeBeg)
             end = min(bedEnd, rangeEnd)
             if beg >= end: continue
@@ -785,17 +911,17 @@ def bedBoxes(annots, rangeDict, limit, isTop, bpPerPix):
             if layer <= 10000:
                 # include partly-covered pixels
                 pixBeg = (origin + beg) // bpPerPix
-                pixEnd = div_ceil(origin + end, bpPerPix)
+                pixEnd = -((origin + end) // negBpPerPix)
             else:
                 # exclude partly-covered pixels
-                pixBeg = div_ceil(origin + beg, bpPerPix)
+                pixBeg = -((origin + beg) // negBpPerPix)
                 pixEnd = (origin + end) // bpPerPix
                 if pixEnd <= pixBeg: continue
                 if bedEnd >= rangeEnd:  # include partly-covered end pixels
                     if isReverseRange:
                         pixBeg = (origin + beg) // bpPerPix
                     else:
-                        pixEnd = div_ceil(origin + end, bpPerPix)
+                        pixEnd = -((origin + end) // negBpPerPix)
             nameBeg = (pixBeg + pixEnd - textHeight) // 2
             nameEnd = nameBeg + textHeight
             n = ""
@@ -837,11 +963,15 @@ def placedLabels(labels, rangePixBegs, rangePixLens, beg, end):
 def nonoverlappingLabels(labels, minPixTweenLabels):
     '''Get a subset of non-overlapping axis labels, greedily.'''
     out = []
+    spans = []  # (beg, end) of the labels in out: they don't overlap, so
+                # sorting them by beg sorts their ends too
     for i in labels:
         beg = i[1] - minPixTweenLabels
         end = i[2] + minPixTweenLabels
-        if all(j[2] <= beg or j[1] >= end for j in out):
+        k = bisect.bisect_left(spans, (end,))
+        if k == 0 or spans[k - 1][1] <= beg:
             out.append(i)
+            bisect.insort(spans, (i[1], i[2]))
     return out
 
 def axisImage(labels, rangePixBegs, rangePixLens, textRot,
@@ -868,6 +998,7 @@ def annoTextImage(opts, image_mode, font, margin, length, boxes, isLeftAlign):
     im = Image.new(image_mode, image_size, opts.margin_color)
     draw = ImageDraw.Draw(im)
     for layer, color, isTop, beg, end, name, nameBeg, nameLen in boxes:
+        if not name: continue  # most boxes have no room for their name
         xPosition = 0 if isLeftAlign else margin - nameLen
         position = xPosition, nameBeg
         draw.text(position, name, font=font, fill="black")
@@ -920,21 +1051,22 @@ def sequenceSizesAndNames(seqRanges):
         yield size, seqName
 
 def biggestSequences(seqRanges, maxNumOfSequences):
-    s = sorted(sequenceSizesAndNames(seqRanges), reverse=True)
+    s = list(sequenceSizesAndNames(seqRanges))
     if len(s) > maxNumOfSequences:
         logging.warning("too many sequences - discarding the smallest ones")
-        s = s[:maxNumOfSequences]
+        s = heapq.nlargest(maxNumOfSequences, s)
     return set(i[1] for i in s)
 
 def remainingSequenceRanges(seqRanges, alignments, seqIndex):
     remainingSequences = set(i[seqIndex] for i in alignments)
     return [i for i in seqRanges if i[0] in remainingSequences]
 
-def readAnnots(opts, font, textDraw, sortedRanges, totalLength, fileNames):
+def readAnnots(opts, font, textDraw, sizeCache, sortedRanges, totalLength,
+               fileNames):
     rangeDict = expandedSeqDict(dict(rangesPerSeq(sortedRanges)))
     annots = sorted(annotsFromFiles(opts, fileNames, rangeDict))
     names = set(i[5] for i in annots)
-    textSizes = dict(sizesPerText(names, font, textDraw))
+    textSizes = dict(sizesPerText(names, font, textDraw, sizeCache))
     maxTextLength = totalLength // 2
     okLengths = [i[0] for i in textSizes.values() if i[0] <= maxTextLength]
     margin = max(okLengths) if okLengths else 0
@@ -950,9 +1082,18 @@ def lastDotplot(opts):
     reverse_color = ImageColor.getcolor(opts.reversecolor, image_mode)
     zipped_colors = zip(forward_color, reverse_color)
     overlap_color = tuple([(i + j) // 2 for i, j in zipped_colors])
+    hitColors = (0, 0, 0), forward_color, reverse_color, overlap_color
+    hitPalette = [j for i in hitColors for j in i]  # indexed by strand bits
+    hitMaskTable = [0] + [255] * 255  # opaque wherever there is a hit
+
+    textDraw = None  # the same one for every plot, so text sizes are reused
+    sizeCache = {}  # text sizes, for just this call
+    if opts.fontsize:
+        textDraw = ImageDraw.Draw(Image.new(image_mode, (1, 1)))
 
     maxGap1, maxGapB1 = twoValuesFromOption(opts.max_gap1, ":")
     maxGap2, maxGapB2 = twoValuesFromOption(opts.max_gap2, ":")
+    joinA, joinB = twoValuesFromOption(opts.join, ":")
 
     # logging.info("reading alignments...")
     count = 1
@@ -995,26 +1136,24 @@ def lastDotplot(opts):
                                 cutRanges1, cutRangesB1, cutRanges2, cutRangesB2)
         sortedRanges1, sortedRanges2 = sortOut
 
-        textDraw = None
-        if opts.fontsize:
-            textDraw = ImageDraw.Draw(Image.new(image_mode, (1, 1)))
-
         textRot1 = "vertical".startswith(opts.rot1)
-        i1 = dataFromRanges(sortedRanges1, font, textDraw, opts.labels1, textRot1)
+        i1 = dataFromRanges(sortedRanges1, font, textDraw, sizeCache,
+                            opts.labels1, textRot1)
         rangeSizes1, labelData1, tMargin = i1
 
         textRot2 = "horizontal".startswith(opts.rot2)
-        i2 = dataFromRanges(sortedRanges2, font, textDraw, opts.labels2, textRot2)
+        i2 = dataFromRanges(sortedRanges2, font, textDraw, sizeCache,
+                            opts.labels2, textRot2)
         rangeSizes2, labelData2, lMargin = i2
 
         logging.info("reading annotations...")
 
-        annots1 = readAnnots(opts, font, textDraw, sortedRanges1, opts.height,
-                            opts.bed1)
+        annots1 = readAnnots(opts, font, textDraw, sizeCache, sortedRanges1,
+                             opts.height, opts.bed1)
         bMargin = annots1[-1]
 
-        annots2 = readAnnots(opts, font, textDraw, sortedRanges2, opts.width,
-                            opts.bed2)
+        annots2 = readAnnots(opts, font, textDraw, sizeCache, sortedRanges2,
+                             opts.width, opts.bed2)
         rMargin = annots2[-1]
 
         maxPixels1 = opts.width  - lMargin - rMargin
@@ -1041,15 +1180,21 @@ def lastDotplot(opts):
 
         logging.info("processing alignments...")
         allAlignments = alignments + alignmentsB
-        hits = alignmentPixels(width, height, allAlignments, bpPerPix,
-                            rangeDict1, rangeDict2)
-
+        # expand the names once: the alignments need only the full names,
+        # but the annotations may use short ones
         rangeDict1 = expandedSeqDict(rangeDict1)
         rangeDict2 = expandedSeqDict(rangeDict2)
+        rangeEnds1 = rangeEndsPerSeq(rangeDict1)
+        rangeEnds2 = rangeEndsPerSeq(rangeDict2)
+        hits = alignmentPixels(width, height, allAlignments, bpPerPix,
+                            rangeDict1, rangeDict2, rangeEnds1, rangeEnds2)
 
-        boxes1 = list(bedBoxes(annots1, rangeDict1, rMarginBeg, True, bpPerPix))
-        boxes2 = list(bedBoxes(annots2, rangeDict2, bMarginBeg, False, bpPerPix))
-        boxes = sorted(itertools.chain(boxes1, boxes2))
+        boxes1 = list(bedBoxes(annots1, rangeDict1, rangeEnds1, rMarginBeg,
+                               True, bpPerPix))
+        boxes2 = list(bedBoxes(annots2, rangeDict2, rangeEnds2, bMarginBeg,
+                               False, bpPerPix))
+        # boxes with the same layer & color can be painted in any order
+        boxes = sorted(itertools.chain(boxes1, boxes2), key=itemgetter(0, 1))
 
         logging.info("drawing...")
 
@@ -1058,23 +1203,32 @@ def lastDotplot(opts):
 
         drawAnnotations(im, boxes, tMargin, bMarginBeg, lMargin, rMarginBeg)
 
-        joinA, joinB = twoValuesFromOption(opts.join, ":")
-        if joinA in "13":
-            drawJoins(im, alignments, bpPerPix, 0, rangeDict1, rangeDict2)
-        if joinB in "13":
-            drawJoins(im, alignmentsB, bpPerPix, 0, rangeDict1, rangeDict2)
-        if joinA in "23":
-            drawJoins(im, alignments, bpPerPix, 1, rangeDict2, rangeDict1)
-        if joinB in "23":
-            drawJoins(im, alignmentsB, bpPerPix, 1, rangeDict2, rangeDict1)
-
-        for i in range(height):
-            for j in range(width):
-                store_value = hits[i * width + j]
-                xy = j, i
-                if   store_value == 1: im.putpixel(xy, forward_color)
-                elif store_value == 2: im.putpixel(xy, reverse_color)
-                elif store_value == 3: im.putpixel(xy, overlap_color)
+        if joinA in "123" or joinB in "123":
+            # mark all the joins, then paste them once
+            joins = bytearray(width * height)
+            if joinA in "13":
+                drawJoins(joins, width, alignments, bpPerPix, 0,
+                          rangeDict1, rangeDict2, rangeEnds1, rangeEnds2)
+            if joinB in "13":
+                drawJoins(joins, width, alignmentsB, bpPerPix, 0,
+                          rangeDict1, rangeDict2, rangeEnds1, rangeEnds2)
+            if joinA in "23":
+                drawJoins(joins, width, alignments, bpPerPix, 1,
+                          rangeDict2, rangeDict1, rangeEnds2, rangeEnds1)
+            if joinB in "23":
+                drawJoins(joins, width, alignmentsB, bpPerPix, 1,
+                          rangeDict2, rangeDict1, rangeEnds2, rangeEnds1)
+            im.paste("lightgray", mask=Image.frombytes("L", image_size, joins))
+
+        # color the hits by table lookup, & paste them over the annotations,
+        # only in the box around the hits
+        hitMask = Image.frombytes("L", image_size, hits)
+        box = hitMask.getbbox()
+        if box:
+            hitImage = Image.frombytes("P", image_size, hits).crop(box)
+            hitImage.putpalette(hitPalette)
+            mask = hitMask.crop(box).point(hitMaskTable)
+            im.paste(hitImage.convert(image_mode), box, mask)
 
         if opts.fontsize != 0:
             axis1 = axisImage(labelData1, rangePixBegs1, rangePixLens1,